@@ -2,69 +2,202 @@
 
 import os
 import uuid
+import datetime
 import time
 import logging
 import random # Keep for potential future use (jitter)
 import html
+import string
 import re
+import threading
+import multiprocessing
+import hashlib
+import math
 import traceback
+import pickle
+import gzip
+import sqlite3
+from collections import OrderedDict
 from io import BytesIO
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 
 from flask import (
     Flask, render_template, request, jsonify,
     send_file, make_response, current_app
 )
 from dotenv import load_dotenv
+from cachetools import TTLCache
+try:
+    import orjson
+except ImportError:  # Optional: Flask's json is used without it
+    orjson = None
+import diskcache
 import google.generativeai as genai
 from duckduckgo_search import DDGS
 import requests
-from bs4 import BeautifulSoup
-import trafilatura
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+try:
+    import redis
+except ImportError:  # Optional: reports stay process-local without it
+    redis = None
 import mistune
+from extraction import extract_main_content, init_extraction_worker
 
 from docx import Document
 from docx.shared import Pt, Inches
+from docx.oxml import parse_xml
+from docx.oxml.ns import nsdecls
+from xml.sax.saxutils import escape as xml_escape
 from xhtml2pdf import pisa
+try:
+    from weasyprint import HTML as WeasyHTML, CSS as WeasyCSS
+except (ImportError, OSError):  # Optional: needs Pango/Cairo system libraries; xhtml2pdf is used without it
+    WeasyHTML = WeasyCSS = None
+try:
+    import pdfkit
+except ImportError:  # Optional: wkhtmltopdf backend
+    pdfkit = None
 
 # --- Configuration ---
 load_dotenv()
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - [%(funcName)s:%(lineno)d] - %(message)s'
-)
+LOG_FORMAT = '%(asctime)s - %(levelname)s - [%(funcName)s:%(lineno)d] - %(message)s'
+logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
 
 # --- Constants ---
 QUICK_SEARCH_RESULTS = 7
 DEEP_SEARCH_RESULTS = 18
 SCRAPE_TIMEOUT = 8
-MAX_CONTENT_LENGTH_PER_SITE = 15000
+SCRAPE_MAX_WORKERS = 16
+SCRAPE_DEADLINE = 20  # Seconds scrape_urls waits for page fetches overall; slower pages are skipped
+SNIPPET_MIN_LENGTH = 400  # Quick mode uses a DDG snippet this long instead of fetching the page
+MIN_GOOD_SOURCES = {'quick': 5, 'deep': 12}  # Stop waiting for slower pages once this many sources have content
+HOST_MIN_INTERVAL = 0.5  # Seconds between fetch starts on the same host (politeness)
 MAX_TOTAL_CONTENT_LENGTH = 200000
-REPORT_STORE_MAX_ITEMS = 100
+MAX_PROMPT_CONTEXT_LENGTH = 200000  # Characters of source text sent to Gemini (~50K tokens)
+CONTEXT_CACHE_MIN_LENGTH = 16384  # Gemini only caches contexts of ~4K tokens or more
+CONTEXT_CACHE_TTL = 600  # Seconds; the cache is deleted as soon as the chunks finish
+REPORT_STORE_MAX_ITEMS = 1000
+REPORT_STORE_TTL = 24 * 3600  # Seconds a report stays downloadable
+REDIS_URL = os.getenv("REDIS_URL")  # Set to share reports across worker processes
+PDF_BACKEND = os.getenv("PDF_BACKEND", "auto").lower()  # auto | weasyprint | wkhtmltopdf | xhtml2pdf
+EXPORT_PRERENDER_FORMATS = ('pdf', 'docx')  # Rendered in the background as soon as a report is stored
+EXPORT_MAX_WORKERS = 2
+JSON_GZIP_MIN_BYTES = 1024  # Smaller JSON bodies are sent uncompressed
+JSON_GZIP_LEVEL = 4  # Most of level 9's ratio on repetitive HTML/JSON at a fraction of the CPU
+DOWNLOAD_CACHE_CONTROL = "private, max-age=3600"  # A report's exports never change, so browsers may reuse them
+SEMANTIC_CACHE_EMBEDDING_MODEL = "models/gemini-embedding-001"
+SEMANTIC_CACHE_DIMENSIONS = 768  # Truncated embedding size; plenty for near-duplicate query detection
+SEMANTIC_CACHE_THRESHOLD = 0.93  # Cosine similarity above which a stored report answers a new query
+SEMANTIC_CACHE_EMBED_WORKERS = 4  # Query embeddings run here while the request thread searches
 SOURCE_PREVIEW_LENGTH = 300
+SOURCE_SUMMARY_FIELDS = ("id", "url", "title", "text_preview")  # What the client and report_store keep per source
+TRACKING_QUERY_PREFIXES = ('utm_', 'fbclid', 'gclid')
+CITATION_SKIP_TOKENS = frozenset({'link', 'image'})
+MAX_BYTES_PER_SOURCE = 1_000_000  # HTML read per page; longer bodies are cut here (the text cap is reached well before)
+SCRAPE_CACHE_MAX_ITEMS = 512
+# Per-user by default: a shared, predictable directory would let another local user plant cache entries
+SCRAPE_CACHE_DIR = os.getenv("SCRAPE_CACHE_DIR") or os.path.join(os.getenv("XDG_CACHE_HOME") or os.path.join(os.path.expanduser('~'), '.cache'), 'ai-research-assistant', 'scrape')
+SCRAPE_CACHE_SIZE_LIMIT = 256 * 1024 * 1024  # Bytes on disk before the oldest entries are evicted
+SCRAPE_CACHE_TTL = 24 * 3600  # Seconds a successful scrape is reused (shared across workers and restarts)
+SCRAPE_NEGATIVE_CACHE_TTL = 600  # Seconds a failed URL is skipped before retrying
+SCRAPE_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36 ResearchAssistantBot/1.0'
+}
+
+# --- Precompiled patterns (ASCII-only, so compiled with re.ASCII) ---
+_RE_CITE_GROUP = re.compile(r"\[\s*(\d+\s*(?:,\s*\d+\s*)*)\s*\]", re.ASCII)
+_RE_CITE_ADJACENT = re.compile(r"(\[\d+\])(\[\d+\])", re.ASCII)
+# The neighbouring-character rules for citation markers are checked in find_citation_markers.
+_RE_CITE_MARKER = re.compile(r"\[(\d+)\]", re.ASCII)
+CITATION_EXCLUDED_PRECEDING_CHARS = frozenset("!]/" + string.ascii_letters + string.digits)
+_RE_NUMBERED_ITEM = re.compile(r"^\d+\.\s+", re.ASCII)
+# Unicode-aware on purpose: letters and digits in any script stay in download filenames
+_RE_FILENAME_UNSAFE = re.compile(r"\W")
+
+# --- Shared HTTP session (keep-alive connection pooling across scrapes) ---
+SESSION = requests.Session()
+SESSION.headers.update(SCRAPE_HEADERS)
+# Retries back off exponentially (0.5s, 1s) on 429/5xx; Retry-After is ignored so a throttling
+# host cannot stall a scrape thread for as long as it asks. Read timeouts are not retried.
+SCRAPE_RETRY = Retry(total=2, connect=1, read=0, status=2, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504), respect_retry_after_header=False, raise_on_status=False)
+_http_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=SCRAPE_RETRY)
+SESSION.mount('https://', _http_adapter)
+SESSION.mount('http://', _http_adapter)
 
 # --- In-memory storage ---
-report_store = {}
-report_order = []
+def open_scrape_cache():
+    """
+    Opens the on-disk scrape cache (process- and thread-safe), or returns None
+    to scrape without it. The directory is created private (0700) and refused
+    if another user owns it; records are stored as JSON, so nothing read back
+    from disk is unpickled.
+    """
+    try:
+        os.makedirs(SCRAPE_CACHE_DIR, mode=0o700, exist_ok=True)
+        if hasattr(os, 'getuid'):
+            if os.stat(SCRAPE_CACHE_DIR).st_uid != os.getuid(): logging.warning(f"Scrape cache directory {SCRAPE_CACHE_DIR} is owned by another user; scraping without the cache."); return None
+            os.chmod(SCRAPE_CACHE_DIR, 0o700)
+        return diskcache.Cache(SCRAPE_CACHE_DIR, size_limit=SCRAPE_CACHE_SIZE_LIMIT, disk=diskcache.JSONDisk)
+    except (OSError, sqlite3.Error) as e: logging.warning(f"Scrape cache unavailable at {SCRAPE_CACHE_DIR}, scraping without it: {e}"); return None
+
+_scrape_cache = open_scrape_cache()
+_scrape_failure_cache = TTLCache(maxsize=SCRAPE_CACHE_MAX_ITEMS, ttl=SCRAPE_NEGATIVE_CACHE_TTL)
+_scrape_cache_lock = threading.Lock()
+_host_next_fetch = TTLCache(maxsize=1024, ttl=60)  # Only recent hosts matter for spacing
+_host_next_fetch_lock = threading.Lock()
+_extraction_pool = None
+_extraction_pool_lock = threading.Lock()
+
+report_store = TTLCache(maxsize=REPORT_STORE_MAX_ITEMS, ttl=REPORT_STORE_TTL)
+_report_store_lock = threading.RLock()
+_report_redis = redis.Redis.from_url(REDIS_URL) if redis and REDIS_URL else None
+_semantic_cache = OrderedDict()  # report_id -> (depth, unit-length query embedding)
+_semantic_cache_lock = threading.Lock()
+_export_pool = ThreadPoolExecutor(max_workers=EXPORT_MAX_WORKERS, thread_name_prefix='export')
+_embedding_pool = ThreadPoolExecutor(max_workers=SEMANTIC_CACHE_EMBED_WORKERS, thread_name_prefix='embed')
+_export_jobs = {}  # (report_id, fmt) -> Future of an in-flight render; removed once it finishes
+_export_jobs_lock = threading.Lock()
 
 def add_to_report_store(report_id, data):
     """
-    Add a report to the in-memory store, managing maximum number of items.
+    Add a report to the store, managing maximum number of items and age.
+
+    Reports expire after REPORT_STORE_TTL seconds and the least recently used
+    are evicted beyond REPORT_STORE_MAX_ITEMS. When REDIS_URL is set the
+    report is also written to Redis so download links work on any worker.
 
     Args:
         report_id (str): Unique identifier for the report
         data (dict): Report data to store
     """
-    if len(report_store) >= REPORT_STORE_MAX_ITEMS:
-        try:
-            oldest_id = report_order.pop(0)
-            if oldest_id in report_store:
-                del report_store[oldest_id]
-                logging.info(f"Removed oldest report ({oldest_id}).")
-        except IndexError:
-            pass  # No reports to remove
+    with _report_store_lock: report_store[report_id] = data
+    if _report_redis is not None:
+        try: _report_redis.setex(f"report:{report_id}", REPORT_STORE_TTL, pickle.dumps(data))
+        except redis.RedisError as e: logging.warning(f"Could not write report {report_id} to Redis: {e}")
 
-    report_store[report_id] = data
-    report_order.append(report_id)
+
+def get_from_report_store(report_id):
+    """
+    Look up a report, falling back to Redis (when configured) for reports
+    created by another worker.
+
+    Args:
+        report_id (str): Unique identifier for the report
+
+    Returns:
+        dict | None: Report data, or None if it is unknown or expired
+    """
+    with _report_store_lock: data = report_store.get(report_id)
+    if data is None and _report_redis is not None:
+        try: raw = _report_redis.get(f"report:{report_id}")
+        except redis.RedisError as e: logging.warning(f"Could not read report {report_id} from Redis: {e}"); raw = None
+        if raw:
+            data = pickle.loads(raw)
+            with _report_store_lock: report_store[report_id] = data
+    return data
 
 # --- Helper Functions ---
 
@@ -100,95 +233,221 @@ def perform_search(query: str, num_results: int) -> list[dict]:
     logging.info(f"Found {len(results)} results.")
     return results
 
-def scrape_url(url: str, timeout: int = SCRAPE_TIMEOUT) -> str | None:
+def canonicalize_url(url: str) -> str:
+    """
+    Normalizes a URL for de-duplication: lowercases scheme/host, drops the
+    fragment, trailing slash and tracking parameters, and sorts the query.
+    A URL urlsplit cannot parse (e.g. an unbalanced IPv6 bracket) is its own key.
     """
-    Scrape the main content from a given URL, with Trafilatura fix.
+    try: parts = urlsplit(url)
+    except ValueError: return url
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if not k.startswith(TRACKING_QUERY_PREFIXES)]
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip('/') or '/', urlencode(sorted(query)), ''))
+
+
+def scrape_cache_key(url: str) -> str:
+    """Return the on-disk scrape cache key for a URL."""
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+def scrape_url(url: str, timeout: int = SCRAPE_TIMEOUT, force_refresh: bool = False) -> str | None:
+    """
+    Scrape the main content from a given URL, reusing recent results.
+
+    Successful extractions are kept in the on-disk cache for SCRAPE_CACHE_TTL
+    seconds as {text, fetched_at} records, and failed URLs are skipped for
+    SCRAPE_NEGATIVE_CACHE_TTL seconds, so sources shared by related queries
+    are not fetched and parsed again.
 
     Args:
         url (str): URL to scrape
         timeout (int): Request timeout in seconds
+        force_refresh (bool): Ignore cached results and fetch the page again
 
     Returns:
         str | None: Scraped content or None if scraping fails
     """
-    logging.info(f"Attempting scrape: {url}")
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36 ResearchAssistantBot/1.0'
-    }
+    key = scrape_cache_key(url)
+    if not force_refresh:
+        record = None
+        if _scrape_cache is not None:
+            try: record = _scrape_cache.get(key)
+            except (diskcache.Timeout, sqlite3.Error) as e: logging.warning(f"Scrape cache read failed for {url}: {e}")
+        if record is not None: logging.info(f"Scrape cache hit ({time.time() - record['fetched_at']:.0f}s old): {url}"); return record['text']
+        with _scrape_cache_lock: recently_failed = url in _scrape_failure_cache
+        if recently_failed: logging.info(f"Skipping recently failed URL: {url}"); return None
+
+    content = _scrape_url_uncached(url, timeout)
+    if not content:
+        with _scrape_cache_lock: _scrape_failure_cache[url] = True
+    elif _scrape_cache is not None:
+        try: _scrape_cache.set(key, {"text": content, "fetched_at": time.time()}, expire=SCRAPE_CACHE_TTL)
+        except (diskcache.Timeout, sqlite3.Error) as e: logging.warning(f"Scrape cache write failed for {url}: {e}")
+    return content
+
+
+def wait_for_host_slot(url: str) -> None:
+    """
+    Per-host politeness: blocks until at least HOST_MIN_INTERVAL seconds have
+    passed since the previous fetch to the same host was allowed to start.
+    Fetches to different hosts never wait on each other.
+    """
+    host = urlsplit(url).netloc.lower()
+    with _host_next_fetch_lock:
+        now = time.monotonic()
+        start_at = max(now, _host_next_fetch.get(host, 0.0))
+        _host_next_fetch[host] = start_at + HOST_MIN_INTERVAL
+    if start_at > now: time.sleep(start_at - now)
+
 
-    # 1. Try Trafilatura
+def _scrape_url_uncached(url: str, timeout: int) -> str | None:
+    """Fetches a URL once and extracts its main content in the extraction process pool."""
+    wait_for_host_slot(url)
+    logging.info(f"Attempting scrape: {url}")
+    content = fetch_html(url, timeout)
+    if content is None: return None
+    pool = get_extraction_pool()
     try:
-        downloaded = trafilatura.fetch_url(url) # Removed timeout kwarg
-        if downloaded:
-            # --- FIX: Use 'txt' for output format ---
-            main_content = trafilatura.extract(
-                downloaded, include_comments=False,
-                include_tables=False, output_format='txt' # CORRECTED format
-            )
-            # --- End FIX ---
-            if main_content and len(main_content) > 100:
-                logging.info(f"Trafilatura success ({len(main_content)} chars): {url}")
-                return main_content.strip()[:MAX_CONTENT_LENGTH_PER_SITE]
-            else:
-                logging.warning(f"Trafilatura extracted minimal/no content (len={len(main_content or '')}) from: {url}")
-        else:
-            logging.warning(f"Trafilatura could not fetch URL (returned None): {url}")
-    except TypeError as te:
-         # Catch TypeErrors which might indicate wrong args for the installed version
-         logging.error(f"Trafilatura extract/fetch failed for {url}: {te.__class__.__name__} - {te}", exc_info=False)
-    except Exception as e:
-        logging.error(f"Trafilatura failed for {url}: {e.__class__.__name__} - {e}", exc_info=False)
+        return pool.submit(extract_main_content, content, url).result()
+    except BrokenProcessPool as e:
+        logging.error(f"Extraction pool unavailable ({e}); extracting in-process: {url}")
+        discard_extraction_pool(pool)
+        return extract_main_content(content, url)
 
-    # 2. Fallback to BeautifulSoup
-    logging.info(f"Falling back to BeautifulSoup for: {url}")
+
+def fetch_html(url: str, timeout: int = SCRAPE_TIMEOUT) -> bytes | None:
+    """
+    Downloads an HTML page through the shared session.
+
+    Non-HTML responses are rejected without reading the body, and at most
+    MAX_BYTES_PER_SOURCE bytes of a page are read; the rest is not downloaded.
+
+    Returns:
+        bytes | None: Raw (possibly truncated) HTML, or None if the fetch fails or is rejected
+    """
     try:
-        response = requests.get(url, timeout=timeout, headers=headers, verify=True)
-        response.raise_for_status()
-        content_type = response.headers.get('Content-Type', '').lower()
-        if 'html' not in content_type: logging.warning(f"Skipping non-HTML ({content_type}): {url}"); return None
-        if len(response.content) > 7_000_000: logging.warning(f"Content size exceeds limit: {url}"); return None
-
-        soup = BeautifulSoup(response.content, 'lxml')
-        potential_containers = [soup.find('article'), soup.find('main'), soup.find('div', id='content'), soup.find('div', class_='content'), soup.find('div', id='main-content'), soup.find('div', class_='main-content'), soup.find('div', class_='entry-content'), soup.find('div', role='main'), soup]
-        text = ""
-        for container in potential_containers:
-            if container:
-                paragraphs = container.find_all('p', recursive=True)
-                if paragraphs:
-                    extracted_text = ' '.join(p.get_text(strip=True) for p in paragraphs)
-                    if len(extracted_text) > 200: text = extracted_text; logging.info(f"BS4 using container '{container.name}' ({len(text)} chars): {url}"); break
-        if not text:
-             all_paragraphs = soup.find_all('p')
-             if all_paragraphs:
-                  extracted_text = ' '.join(p.get_text(strip=True) for p in all_paragraphs)
-                  if len(extracted_text) > 100: text = extracted_text; logging.info(f"BS4 joining all 'p' tags ({len(text)} chars): {url}");
-        if text: return text.strip()[:MAX_CONTENT_LENGTH_PER_SITE]
-        else: body_snippet = soup.body.get_text(strip=True, separator=' ')[0:500] if soup.body else "No body"; logging.warning(f"BS4 fallback found no content. Snippet: '{body_snippet}...': {url}"); return None
+        with SESSION.get(url, timeout=timeout, stream=True) as response:
+            response.raise_for_status()
+            content_type = response.headers.get('Content-Type', '').lower()
+            if 'html' not in content_type: logging.warning(f"Skipping non-HTML ({content_type}): {url}"); return None
+            buffer = bytearray()
+            for chunk in response.iter_content(chunk_size=65536):
+                buffer.extend(chunk)
+                if len(buffer) >= MAX_BYTES_PER_SOURCE: del buffer[MAX_BYTES_PER_SOURCE:]; logging.info(f"Truncated page at {MAX_BYTES_PER_SOURCE} bytes: {url}"); break
+            return bytes(buffer)
     except requests.exceptions.Timeout: logging.error(f"Timeout (Requests): {url}"); return None
     except requests.exceptions.HTTPError as e: logging.error(f"HTTP Error {e.response.status_code} (Requests): {url}"); return None
     except requests.exceptions.RequestException as e: logging.error(f"RequestException (Requests) {url}: {e}", exc_info=False); return None
-    except Exception as e: logging.error(f"Generic Error BS4 fallback {url}:", exc_info=True); return None
+    except Exception as e: logging.error(f"Generic Error fetching {url}:", exc_info=True); return None
 
 
-def scrape_urls(urls: list[str]) -> list[dict]:
-    """Scrapes multiple URLs."""
-    scraped_data = []; total_content_length = 0; urls_attempted = set()
-    logging.info(f"Starting scrape for {len(urls)} URLs.")
-    for i, url in enumerate(urls):
-        if url in urls_attempted: continue; urls_attempted.add(url)
+def get_extraction_pool() -> ProcessPoolExecutor:
+    """
+    Returns the process pool used for CPU-bound HTML extraction, creating it on first use.
+
+    Workers are spawned (not forked) because the pool is started from a
+    multithreaded server. They only need the extraction module, so
+    extract_main_content lives there rather than here: a worker loads
+    trafilatura and the HTML parsers, not the Flask app and its clients.
+    """
+    global _extraction_pool
+    with _extraction_pool_lock:
+        if _extraction_pool is None:
+            _extraction_pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1, mp_context=multiprocessing.get_context('spawn'), initializer=init_extraction_worker, initargs=(logging.INFO, LOG_FORMAT))
+        return _extraction_pool
+
+
+def discard_extraction_pool(pool: ProcessPoolExecutor) -> None:
+    """Shuts down a broken extraction pool so the next get_extraction_pool() call builds a fresh one."""
+    global _extraction_pool
+    with _extraction_pool_lock:
+        if _extraction_pool is not pool: return  # Another thread already replaced it
+        _extraction_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def scrape_urls(search_results: list[dict], depth: str = 'quick', force_rescrape: bool = False) -> list[dict]:
+    """
+    Scrapes the pages behind multiple search results concurrently.
+
+    In quick mode a result whose DDG snippet is at least SNIPPET_MIN_LENGTH
+    characters is used as-is and its page is not fetched. Fetches overlap in
+    a bounded thread pool and are collected as they finish; once
+    MIN_GOOD_SOURCES[depth] sources have content the stragglers are not
+    waited for (they finish in the background and still fill the scrape
+    cache), and no page is waited for beyond SCRAPE_DEADLINE seconds.
+    Results are assembled in the original search order so source numbering
+    stays stable.
+
+    Args:
+        search_results (list[dict]): Results from perform_search (title, url, body)
+        depth (str): Research depth, 'quick' or 'deep'
+        force_rescrape (bool): Bypass the scrape cache and fetch every page again
+
+    Returns:
+        list[dict]: Scraped sources with id, url, title, text and text_preview
+        (the first SOURCE_PREVIEW_LENGTH characters, cut once here)
+    """
+    scraped_data = []; total_content_length = 0
+    # De-duplicate on the canonical form but fetch (and report) the first original URL
+    results_by_key = {}
+    for result in search_results:
+        if result.get('url'): results_by_key.setdefault(canonicalize_url(result['url']), result)
+    unique_results = list(results_by_key.values())
+    logging.info(f"Starting scrape for {len(unique_results)} URLs.")
+    if not unique_results: return scraped_data
+
+    use_snippet = [depth == 'quick' and len(r.get('body') or '') >= SNIPPET_MIN_LENGTH for r in unique_results]
+    urls_to_fetch = [r['url'] for r, snippet in zip(unique_results, use_snippet) if not snippet]
+    fetched = {}
+    if urls_to_fetch:
+        needed = MIN_GOOD_SOURCES.get(depth, len(unique_results)) - sum(use_snippet); good = 0
+        executor = ThreadPoolExecutor(max_workers=min(SCRAPE_MAX_WORKERS, len(urls_to_fetch)))
+        try:
+            futures = {executor.submit(scrape_url, url, force_refresh=force_rescrape): url for url in urls_to_fetch}
+            for future in as_completed(futures, timeout=SCRAPE_DEADLINE):
+                url = futures[future]
+                try: content = future.result()
+                except Exception as e: logging.error(f"Scrape failed for {url}: {e}"); content = None
+                fetched[url] = content; good += bool(content)
+                if good >= needed and len(fetched) < len(futures): logging.info(f"Have {good} fetched sources; not waiting for {len(futures) - len(fetched)} slower pages."); break
+        except FuturesTimeoutError: logging.warning(f"Scrape deadline ({SCRAPE_DEADLINE}s) reached; skipping {len(futures) - len(fetched)} unfinished pages.")
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+    logging.info(f"Used {sum(use_snippet)} search snippets, fetched {len(fetched)}/{len(urls_to_fetch)} pages.")
+
+    for result, snippet in zip(unique_results, use_snippet):
         if total_content_length >= MAX_TOTAL_CONTENT_LENGTH: logging.warning(f"Reached max total content length."); break
-        content = scrape_url(url)
-        if content: scraped_data.append({"id": len(scraped_data), "url": url, "text": content}); total_content_length += len(content); logging.debug(f"Scrape success {url}")
-        time.sleep(0.3) # Polite delay
-    logging.info(f"Finished scraping. Success: {len(scraped_data)}/{len(urls_attempted)} URLs. Total length: {total_content_length}")
+        url = result['url']; content = result['body'].strip() if snippet else fetched.get(url)
+        if content: scraped_data.append({"id": len(scraped_data), "url": url, "title": result.get('title') or f"Source {len(scraped_data) + 1}", "text": content, "text_preview": content[:SOURCE_PREVIEW_LENGTH]}); total_content_length += len(content); logging.debug(f"Scrape success {url}")
+    logging.info(f"Finished scraping. Success: {len(scraped_data)}/{len(unique_results)} URLs. Total length: {total_content_length}")
     return scraped_data
 
 
 def format_context_for_llm(scraped_data: list[dict]) -> str:
     """Formats scraped data for LLM context."""
-    context_str = ""
-    for item in scraped_data: context_str += f"Source [{item['id']+1}] ({item['url']}):\n{item['text']}\n\n---\n\n"
-    return context_str
+    return "".join(f"Source [{item['id']+1}] ({item['url']}):\n{item['text']}\n\n---\n\n" for item in scraped_data)
+
+
+def fit_sources_to_budget(scraped_data: list[dict], budget: int = MAX_PROMPT_CONTEXT_LENGTH) -> list[dict]:
+    """
+    Truncates or drops sources, in rank order, so their combined text fits the budget.
+
+    Args:
+        scraped_data (list[dict]): Scraped sources in search-rank order
+        budget (int): Maximum total characters of source text
+
+    Returns:
+        list[dict]: Sources whose texts add up to at most `budget` characters
+    """
+    fitted = []; remaining = budget; trimmed = False
+    for item in scraped_data:
+        if remaining <= 0: trimmed = True; break
+        if len(item['text']) > remaining: item = {**item, "text": item['text'][:remaining]}; trimmed = True
+        fitted.append(item); remaining -= len(item['text'])
+    if trimmed:
+        logging.warning(f"Context trimmed to {budget} chars: kept {len(fitted)}/{len(scraped_data)} sources.")
+    return fitted
 
 
 def preprocess_llm_text_for_citations(text: str) -> str:
@@ -202,108 +461,253 @@ def preprocess_llm_text_for_citations(text: str) -> str:
         return " ".join(f"[{num.strip()}]" for num in numbers if num.strip().isdigit())
     
     # Replace comma-separated citations
-    processed_text = re.sub(r"\[\s*(\d+\s*(?:,\s*\d+\s*)*)\s*\]", replacer, text)
+    processed_text = _RE_CITE_GROUP.sub(replacer, text)
     
     # Add space between consecutive citation markers to ensure they're processed separately
-    processed_text = re.sub(r"(\[\d+\])(\[\d+\])", r"\1 \2", processed_text)
+    processed_text = _RE_CITE_ADJACENT.sub(r"\1 \2", processed_text)
     
     return processed_text
 
 
-def process_citation_markers_in_html(html_content: str) -> str:
+def find_citation_markers(text: str) -> list[tuple[int, int, int]]:
     """
-    Improved citation marker processing for HTML content.
-    Handles consecutive citations properly with spacing.
+    Finds standalone [N] citation markers in text.
+
+    A marker is skipped when it directly follows one of "!]/" or an ASCII
+    letter/digit (images, adjacent links, URLs, words), or is followed by "]".
+
+    Returns:
+        list[tuple[int, int, int]]: (start, end, N) for each marker
+    """
+    markers = []
+    for match in _RE_CITE_MARKER.finditer(text):
+        start, end = match.span()
+        if start and text[start - 1] in CITATION_EXCLUDED_PRECEDING_CHARS: continue
+        if text[end:end + 1] == ']': continue
+        markers.append((start, end, int(match.group(1))))
+    return markers
+
+
+def citation_marker_html(num: int) -> str:
+    """Builds the <sup><a class="citation-marker">[N]</a></sup> link for citation N."""
+    return f'<sup><a href="#" class="citation-marker" data-citation-index="{num - 1}" aria-label="Citation {num}">[{num}]</a></sup>'
+
+
+def link_citation_markers(text: str) -> str:
+    """Replaces the [N] markers in (already escaped) text with citation links, each followed by a space."""
+    markers = find_citation_markers(text)
+    if not markers: return text
+    parts = []; position = 0
+    for start, end, num in markers:
+        parts.append(text[position:start]); parts.append(citation_marker_html(num))
+        if not text[end:end + 1].isspace(): parts.append(" ")
+        position = end
+    parts.append(text[position:])
+    return "".join(parts)
+
+
+class CitationHTMLRenderer(mistune.HTMLRenderer):
     """
-    # First pass: Replace all citation markers
-    def replace_citation_html(match):
-        num = int(match.group(1))
-        return f"<sup><a href='#' class='citation-marker' data-citation-index='{num-1}' aria-label='Citation {num}'>[{num}]</a></sup>"
+    HTML renderer that emits citation links while rendering inline text, so
+    no HTML post-processing pass is needed. Markers in code spans/blocks are
+    never text tokens, and text inside links/images is left untouched.
+    """
+
+    def render_token(self, token, state):
+        if token["type"] in CITATION_SKIP_TOKENS:
+            state.env["citation_skip_depth"] = state.env.get("citation_skip_depth", 0) + 1
+            try: return super().render_token(token, state)
+            finally: state.env["citation_skip_depth"] -= 1
+        rendered = super().render_token(token, state)
+        if token["type"] == "text" and not state.env.get("citation_skip_depth"): return link_citation_markers(rendered)
+        return rendered
 
-    processed_html = re.sub(r"(?<![!\]/a-zA-Z0-9])\[(\d+)\](?!\])", replace_citation_html, html_content)
 
-    # Second pass: Add spacing between consecutive sup tags for better rendering
-    processed_html = re.sub(r'(</sup>)(<sup>)', r'\1 \2', processed_html)
+# --- Gemini client state (configured once per API key; models reused across requests) ---
+GEMINI_SAFETY_SETTINGS = [ {"category": c, "threshold": "BLOCK_MEDIUM_AND_ABOVE"} for c in ["HARM_CATEGORY_HARASSMENT", "HARM_CATEGORY_HATE_SPEECH", "HARM_CATEGORY_SEXUALLY_EXPLICIT", "HARM_CATEGORY_DANGEROUS_CONTENT"] ]
+_gemini_models = {}
+_gemini_lock = threading.Lock()
+_gemini_configured_key = None
 
-    return processed_html
 
+def _configure_gemini(api_key: str) -> None:
+    """Configures the genai client if the API key changed. Caller holds _gemini_lock."""
+    global _gemini_configured_key
+    if api_key != _gemini_configured_key:
+        genai.configure(api_key=api_key); _gemini_configured_key = api_key
 
-def generate_chunked_deep_research(model, prompt, safety_settings, query, context_string):
+
+def get_gemini_model(api_key: str, model_name: str):
     """
-    Generates deep research content in chunks to avoid token limit issues.
-    Returns the combined text from all chunks.
+    Returns a cached GenerativeModel for (api_key, model_name), configuring
+    the genai client only when the API key changes.
     """
-    logging.info("Using chunked generation for deep research")
+    with _gemini_lock:
+        _configure_gemini(api_key)
+        model = _gemini_models.get((api_key, model_name))
+        if model is None:
+            model = _gemini_models[(api_key, model_name)] = genai.GenerativeModel(model_name)
+        return model
 
-    # First, generate the structure (title, abstract, intro)
-    structure_prompt = f"""
-    User Query: "{query}"
 
-    Based on the provided sources, generate ONLY the Title, Abstract, and Introduction sections
-    for a comprehensive academic research article. Focus on creating a strong foundation for the
-    article with a clear research question, context, and objectives.
+# --- Semantic answer cache (near-duplicate queries reuse a stored report) ---
+def embed_query(query: str, api_key: str) -> list[float] | None:
+    """
+    Embeds a research query for semantic cache lookups.
 
-    Sources:
-    --- START OF SOURCES ---
-    {context_string}
-    --- END OF SOURCES ---
+    Args:
+        query (str): The user's query
+        api_key (str): Gemini API key
+
+    Returns:
+        list[float] | None: Unit-length embedding, or None if the call fails
     """
+    try:
+        with _gemini_lock: _configure_gemini(api_key)
+        values = genai.embed_content(model=SEMANTIC_CACHE_EMBEDDING_MODEL, content=query, task_type="SEMANTIC_SIMILARITY", output_dimensionality=SEMANTIC_CACHE_DIMENSIONS)["embedding"]
+    except Exception as e: logging.warning(f"Query embedding failed, skipping semantic cache: {e}"); return None
+    norm = math.sqrt(sum(v * v for v in values))
+    return [v / norm for v in values] if norm else None
 
-    structure_response = model.generate_content(
-        structure_prompt,
-        safety_settings=safety_settings,
-        generation_config=genai.types.GenerationConfig(max_output_tokens=2000, temperature=0.6)
-    )
 
-    if not structure_response.candidates or not hasattr(structure_response.candidates[0].content, 'parts'):
-        logging.error("Failed to generate article structure")
+def has_semantic_cache_entries(depth: str) -> bool:
+    """Whether any stored report of this depth could answer a query (lookups are skipped otherwise)."""
+    with _semantic_cache_lock: return any(cached_depth == depth for cached_depth, _ in _semantic_cache.values())
+
+
+def find_similar_report(embedding: list[float], depth: str) -> str | None:
+    """
+    Returns the id of the stored report whose query is most similar to the
+    given embedding (same depth, cosine similarity above SEMANTIC_CACHE_THRESHOLD).
+    Entries whose report has left report_store are pruned on the way.
+    """
+    best_id, best_sim = None, SEMANTIC_CACHE_THRESHOLD
+    with _semantic_cache_lock:
+        with _report_store_lock: expired_ids = [r for r in _semantic_cache if r not in report_store]
+        for report_id in expired_ids: del _semantic_cache[report_id]
+        for report_id, (cached_depth, cached_embedding) in _semantic_cache.items():
+            if cached_depth != depth: continue
+            sim = sum(a * b for a, b in zip(embedding, cached_embedding))
+            if sim > best_sim: best_id, best_sim = report_id, sim
+    if best_id: logging.info(f"Semantic cache hit ({best_sim:.3f}): {best_id}")
+    return best_id
+
+
+def add_to_semantic_cache(report_id: str, depth: str, embedding: list[float]) -> None:
+    """Records a stored report's query embedding, bounded like report_store."""
+    with _semantic_cache_lock:
+        _semantic_cache[report_id] = (depth, embedding)
+        while len(_semantic_cache) > REPORT_STORE_MAX_ITEMS: _semantic_cache.popitem(last=False)
+
+
+# --- Markdown parser (built once; parse state is per call, so it is safe to share) ---
+MD_PARSER = mistune.create_markdown(renderer=CitationHTMLRenderer(), plugins=['strikethrough', 'footnotes', 'table', 'task_lists'])
+
+
+def create_context_cache(model_name: str, context: str):
+    """
+    Uploads shared prompt context to Gemini's context cache.
+
+    Args:
+        model_name (str): Model the cached content is created for
+        context (str): Text shared by several requests
+
+    Returns:
+        genai.caching.CachedContent | None: The cache, or None when the context is
+        too small to cache or the model/API rejects caching
+    """
+    if len(context) < CONTEXT_CACHE_MIN_LENGTH: return None
+    try:
+        cached_context = genai.caching.CachedContent.create(model=model_name, contents=[context], ttl=datetime.timedelta(seconds=CONTEXT_CACHE_TTL))
+        logging.info(f"Created context cache {cached_context.name} ({len(context)} chars).")
+        return cached_context
+    except Exception as e:
+        logging.warning(f"Context caching unavailable, sending sources inline: {e.__class__.__name__} - {e}")
         return None
 
-    # Get the initial content
-    generated_text = structure_response.text
 
-    # Now generate the literature review and analysis
-    middle_prompt = f"""
-    User Query: "{query}"
+def delete_context_cache(cached_context) -> None:
+    """Deletes a context cache early instead of waiting for its TTL."""
+    try: cached_context.delete()
+    except Exception as e: logging.warning(f"Failed to delete context cache {cached_context.name}: {e}")
 
-    Based on the provided sources, generate ONLY the Literature Review and Analysis/Discussion sections
-    for a comprehensive academic research article. The Title, Abstract, and Introduction have already been generated.
-    Focus on thorough analysis of existing research and detailed discussion of findings.
 
+def generate_chunked_deep_research(model, safety_settings, query, context_string):
+    """
+    Generates deep research content in chunks to avoid token limit issues.
+    The chunk prompts are independent, so they are sent to Gemini concurrently.
+    Returns the combined text from all chunks.
+    """
+    logging.info("Using chunked generation for deep research")
+
+    # The sources block is the same for every chunk: build it once and put it
+    # first so the three prompts share one prefix.
+    sources_prefix = f"""
     Sources:
     --- START OF SOURCES ---
     {context_string}
     --- END OF SOURCES ---
     """
 
-    middle_response = model.generate_content(
-        middle_prompt,
-        safety_settings=safety_settings,
-        generation_config=genai.types.GenerationConfig(max_output_tokens=3000, temperature=0.6)
-    )
+    # First chunk: the structure (title, abstract, intro)
+    structure_instructions = f"""
+    User Query: "{query}"
 
-    if middle_response.candidates and hasattr(middle_response.candidates[0].content, 'parts'):
-        generated_text += "\n\n" + middle_response.text
+    Based on the provided sources, generate ONLY the Title, Abstract, and Introduction sections
+    for a comprehensive academic research article. Focus on creating a strong foundation for the
+    article with a clear research question, context, and objectives.
+    """
 
-    # Finally, generate the conclusion and references
-    conclusion_prompt = f"""
+    # Second chunk: the literature review and analysis
+    middle_instructions = f"""
+    User Query: "{query}"
+
+    Based on the provided sources, generate ONLY the Literature Review and Analysis/Discussion sections
+    for a comprehensive academic research article. The Title, Abstract, and Introduction have already been generated.
+    Focus on thorough analysis of existing research and detailed discussion of findings.
+    """
+
+    # Final chunk: the conclusion and references
+    conclusion_instructions = f"""
     User Query: "{query}"
 
     Based on the provided sources, generate ONLY the Conclusion and References sections
     for a comprehensive academic research article. The previous sections have already been generated.
     Focus on summarizing key findings and properly formatting all references.
-
-    Sources:
-    --- START OF SOURCES ---
-    {context_string}
-    --- END OF SOURCES ---
     """
 
-    conclusion_response = model.generate_content(
-        conclusion_prompt,
-        safety_settings=safety_settings,
-        generation_config=genai.types.GenerationConfig(max_output_tokens=2000, temperature=0.6)
-    )
+    # Upload the sources once as cached content so each chunk only sends its
+    # instructions; without a cache the sources are prepended to every chunk.
+    cached_context = create_context_cache(model.model_name, sources_prefix)
+    if cached_context:
+        chunk_model = genai.GenerativeModel.from_cached_content(cached_content=cached_context); prompt_prefix = ""
+    else:
+        chunk_model = model; prompt_prefix = sources_prefix
+
+    def generate_chunk(chunk_prompt, max_output_tokens):
+        return chunk_model.generate_content(
+            chunk_prompt,
+            safety_settings=safety_settings,
+            generation_config=genai.types.GenerationConfig(max_output_tokens=max_output_tokens, temperature=0.6)
+        )
+
+    chunks = [(prompt_prefix + structure_instructions, 2000), (prompt_prefix + middle_instructions, 3000), (prompt_prefix + conclusion_instructions, 2000)]
+    try:
+        with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+            futures = [executor.submit(generate_chunk, p, mx) for p, mx in chunks]
+            structure_response, middle_response, conclusion_response = [f.result() for f in futures]
+    finally:
+        if cached_context: delete_context_cache(cached_context)
+
+    if not structure_response.candidates or not hasattr(structure_response.candidates[0].content, 'parts'):
+        logging.error("Failed to generate article structure")
+        return None
+
+    # Assemble the sections in article order
+    generated_text = structure_response.text
+
+    if middle_response.candidates and hasattr(middle_response.candidates[0].content, 'parts'):
+        generated_text += "\n\n" + middle_response.text
 
     if conclusion_response.candidates and hasattr(conclusion_response.candidates[0].content, 'parts'):
         generated_text += "\n\n" + conclusion_response.text
@@ -311,8 +715,8 @@ def generate_chunked_deep_research(model, prompt, safety_settings, query, contex
     return generated_text
 
 
-def create_gemini_prompt(query: str, context_string: str, depth: str) -> str:
-    """Creates the prompt, adjusted for depth and emphasizing deep research requirements."""
+def create_gemini_prompt(query: str, context_string: str) -> str:
+    """Creates the quick-answer prompt (deep research builds its own per-chunk prompts)."""
     base_instructions = f"""User Query: "{query}"
 
 Sources:
@@ -329,95 +733,12 @@ General Instructions:
 6.  **Tone:** Objective, factual, neutral.
 7.  **Output:** Generate ONLY the Markdown answer, starting directly without preamble.
 """
-    if depth == 'deep':
-        deep_specific_instructions = f"""
-COMPREHENSIVE ACADEMIC RESEARCH ARTICLE GENERATION GUIDELINES
-
-Research Query: "{query}"
-
-ARTICLE STRUCTURE AND EXPECTATIONS:
-1. Length: Generate a comprehensive research article of approximately 10-15 pages (2500-3750 words)
-2. Academic Rigor: Produce a scholarly, well-researched, and critically analyzed response
-3. Formatting: Use academic writing conventions with clear structure
-
-DETAILED ARTICLE COMPONENTS:
-
-I. Title Page
-- Concise, informative title reflecting the research query
-- Subtitle if appropriate
-- Implied academic affiliation (e.g., "Interdisciplinary Research Institute")
-
-II. Abstract (250-300 words)
-- Clearly state research query
-- Summarize key findings
-- Highlight research significance
-- Briefly mention methodological approach
-
-III. Introduction (500-600 words)
-- Contextualize the research query
-- State research objectives
-- Explain significance and relevance
-- Provide theoretical or conceptual framework
-- Present central research questions or hypotheses
-
-IV. Comprehensive Literature Review (800-1000 words)
-- Systematic review of existing research
-- Critical analysis of current knowledge
-- Identify gaps and controversies
-- Synthesize perspectives from multiple sources
-- Demonstrate deep understanding of the topic
-
-V. Detailed Analysis and Discussion (1200-1500 words)
-- In-depth exploration of research findings
-- Integrate evidence from provided sources
-- Present multiple perspectives
-- Critical interpretation of information
-- Address potential counterarguments
-- Connect findings to broader context
-
-VI. Conclusion (400-500 words)
-- Summarize key findings
-- Reflect on research implications
-- Suggest future research directions
-- Provide definitive insights
-
-VII. References
-- Comprehensive list of sources
-- Formatted in APA, MLA, or Chicago style
-- Include all cited sources from web scraping
-- Ensure proper academic citation format
-
-SPECIFIC RESEARCH GUIDELINES:
-- Use academic, formal language
-- Maintain objective, analytical tone
-- Critically evaluate and synthesize information
-- Provide nuanced, balanced perspectives
-- Demonstrate scholarly depth and intellectual rigor
-
-CITATION INSTRUCTIONS:
-- Use numbered citation markers [1], [2], etc.
-- Cite sources for all claims and data points
-- Paraphrase and quote appropriately
-- Maintain academic integrity
-
-CONTEXT FROM WEB SOURCES:
-{context_string}
-
-FINAL INSTRUCTIONS:
-- Prioritize accuracy and scholarly integrity
-- Do not fabricate information
-- If sources are insufficient, clearly state limitations
-- Aim for a comprehensive, authoritative response
-
-Generate the complete research article following these guidelines."""
-        return base_instructions + deep_specific_instructions + "\nSynthesized Deep Research Article (Markdown format):"
-    else: # Quick depth
-        quick_specific_instructions = """
+    quick_specific_instructions = """
 Specific Instructions for Quick Answer:
 *   **Goal:** Concise, informative answer synthesizing key points from sources.
 *   **Structure:** Use paragraphs, `### Subheadings` (optional), `* Bullet points`.
 """
-        return base_instructions + quick_specific_instructions + "\nSynthesized Answer (Markdown format):"
+    return base_instructions + quick_specific_instructions + "\nSynthesized Answer (Markdown format):"
 
 
 def synthesize_with_gemini(query: str, scraped_data: list[dict], api_key: str, depth: str) -> dict | None:
@@ -425,23 +746,23 @@ def synthesize_with_gemini(query: str, scraped_data: list[dict], api_key: str, d
     if not api_key: return {"error": "AI key missing."}
     if not scraped_data: return {"error": "No content to synthesize."}
 
-    genai.configure(api_key=api_key)
-    context_string = format_context_for_llm(scraped_data)
-    prompt = create_gemini_prompt(query, context_string, depth)
+    context_string = format_context_for_llm(fit_sources_to_budget(scraped_data))
+    # Deep research builds its own per-chunk prompts, so only quick mode needs the full prompt
+    prompt = create_gemini_prompt(query, context_string) if depth != 'deep' else None
 
-    estimated_tokens = len(prompt) / 4
+    estimated_tokens = len(prompt or context_string) / 4
     logging.info(f"Sending prompt to Gemini for '{depth}'. Estimated context: ~{estimated_tokens:.0f} tokens.")
 
     model_name = 'gemini-2.0-flash' if depth == 'deep' else 'gemini-2.0-flash'
     max_tokens = 8192 # Keep generous
     logging.info(f"Using model: {model_name} (max_tokens={max_tokens})")
-    model = genai.GenerativeModel(model_name)
-    safety_settings = [ {"category": c, "threshold": "BLOCK_MEDIUM_AND_ABOVE"} for c in ["HARM_CATEGORY_HARASSMENT", "HARM_CATEGORY_HATE_SPEECH", "HARM_CATEGORY_SEXUALLY_EXPLICIT", "HARM_CATEGORY_DANGEROUS_CONTENT"] ]
+    model = get_gemini_model(api_key, model_name)
+    safety_settings = GEMINI_SAFETY_SETTINGS
 
     try:
         # For deep research, use chunked generation to avoid token limit issues
         if depth == 'deep':
-            generated_text_raw = generate_chunked_deep_research(model, prompt, safety_settings, query, context_string)
+            generated_text_raw = generate_chunked_deep_research(model, safety_settings, query, context_string)
             if not generated_text_raw:
                 return {"error": "Failed to generate deep research content"}
         else:
@@ -459,19 +780,7 @@ def synthesize_with_gemini(query: str, scraped_data: list[dict], api_key: str, d
         generated_text_processed = preprocess_llm_text_for_citations(generated_text_raw)
 
         # Convert markdown to HTML
-        markdown_parser = mistune.create_markdown(renderer='html', plugins=['strikethrough', 'footnotes', 'table', 'task_lists'])
-        html_answer = markdown_parser(generated_text_processed)
-        
-        # Process citation markers in HTML with improved regex
-        # This regex carefully matches individual citation markers
-        html_answer = re.sub(
-            r"(?<![!\]/a-zA-Z0-9])\[(\d+)\](?!\])", 
-            lambda m: f"<sup><a href='#' class='citation-marker' data-citation-index='{int(m.group(1))-1}' aria-label='Citation {m.group(1)}'>[{m.group(1)}]</a></sup> ",  # Note the space after </sup>
-            html_answer
-        )
-        
-        # Clean up any excessive spaces that might have been added
-        html_answer = re.sub(r"(\s{2,})", " ", html_answer)
+        html_answer = MD_PARSER(generated_text_processed)
         
         logging.info(f"Successfully generated response. Processed length: {len(generated_text_processed)}")
         return {"answer_raw": generated_text_processed, "answer_html": html_answer}
@@ -492,25 +801,60 @@ def synthesize_with_gemini(query: str, scraped_data: list[dict], api_key: str, d
 
         return {"error": err_msg}
 
+def _docx_paragraph_xml(lines: list[str]) -> str:
+    """Builds a <w:p> holding the given lines, separated by Word line breaks."""
+    text_xml = '<w:br/>'.join(f'<w:t xml:space="preserve">{xml_escape(line)}</w:t>' for line in lines)
+    return f'<w:p><w:r>{text_xml}</w:r></w:p>'
+
+
+def _append_body_xml(document, paragraphs_xml: list[str]) -> None:
+    """Parses a batch of <w:p> fragments at once and appends them to the body (before sectPr)."""
+    batch = parse_xml(f'<w:body {nsdecls("w")}>{"".join(paragraphs_xml)}</w:body>')
+    body = document.element.body; sect_pr = body.sectPr
+    for paragraph in list(batch):
+        if sect_pr is not None: sect_pr.addprevious(paragraph)
+        else: body.append(paragraph)
+
+
+# --- DOCX base template (built once; each report starts from a copy of these bytes) ---
+def _build_docx_base_template() -> bytes:
+    """Builds the shared DOCX starting point: Arial 11pt Normal style and the report title heading."""
+    document = Document()
+    default_font = document.styles['Normal'].font; default_font.name = 'Arial'; default_font.size = Pt(11)
+    document.add_heading("Research Report", level=1)
+    template_stream = BytesIO(); document.save(template_stream); return template_stream.getvalue()
+
+
+DOCX_BASE_TEMPLATE = _build_docx_base_template()
+
+
 # --- UPDATED generate_docx ---
 def generate_docx(report_data: dict) -> BytesIO:
     """Generates DOCX, fixing content addition and conditional source list."""
-    document = Document()
+    document = Document(BytesIO(DOCX_BASE_TEMPLATE))
     try:
-        default_font = document.styles['Normal'].font; default_font.name = 'Arial'; default_font.size = Pt(11)
         query = report_data.get('query', 'Untitled Report')
-        document.add_heading("Research Report", level=1)
         p = document.add_paragraph(); p.add_run("Query: ").bold = True; p.add_run(query); document.add_paragraph()
 
         answer_content_processed = report_data.get('answer_raw', 'Content not available.')
         # --- FIX: Refined Markdown to DOCX paragraph handling ---
-        current_paragraph = None
+        # Plain paragraphs are collected as raw OOXML and appended in batches;
+        # python-docx is only used for headings and list items (style lookup).
+        paragraph_lines = []; pending_xml = []
+
+        def end_paragraph():
+            if paragraph_lines: pending_xml.append(_docx_paragraph_xml(paragraph_lines)); paragraph_lines.clear()
+
+        def flush_paragraphs():
+            end_paragraph()
+            if pending_xml: _append_body_xml(document, pending_xml); pending_xml.clear()
+
         for line in answer_content_processed.split('\n'):
             stripped_line = line.strip()
 
             # Heading detection
             if stripped_line.startswith('#'):
-                current_paragraph = None # End previous paragraph before heading
+                flush_paragraphs() # End previous paragraph before heading
                 level = stripped_line.count('#', 0, 3)
                 heading_text = stripped_line.lstrip('# ').strip()
                 if heading_text: document.add_heading(heading_text, level=min(level, 3))
@@ -524,28 +868,21 @@ def generate_docx(report_data: dict) -> BytesIO:
                 is_list_item = True
                 list_content = stripped_line[2:]
                 list_style = 'List Bullet'
-            elif re.match(r"^\d+\.\s+", stripped_line):
+            elif _RE_NUMBERED_ITEM.match(stripped_line):
                  is_list_item = True
-                 list_content = re.sub(r"^\d+\.\s+", "", stripped_line)
+                 list_content = _RE_NUMBERED_ITEM.sub("", stripped_line)
                  list_style = 'List Number'
 
             if is_list_item:
-                current_paragraph = None # End previous paragraph before list item
+                flush_paragraphs() # End previous paragraph before list item
                 if list_content: # Avoid adding empty list items
                     document.add_paragraph(list_content, style=list_style)
                 continue # Move to next line after handling list item
 
-            # Normal paragraph text
-            if stripped_line:
-                if current_paragraph is None:
-                    # Start a new paragraph if not continuing one or after heading/list
-                    current_paragraph = document.add_paragraph(stripped_line)
-                else:
-                    # Add line break *within* the current paragraph
-                    current_paragraph.add_run("\n" + stripped_line) # Use Word line break
-            elif current_paragraph is not None:
-                 # Empty line signifies paragraph break
-                 current_paragraph = None
+            # Normal paragraph text: consecutive lines share one paragraph (joined by Word line breaks)
+            if stripped_line: paragraph_lines.append(stripped_line)
+            else: end_paragraph() # Empty line signifies paragraph break
+        flush_paragraphs()
 
         # --- End FIX ---
 
@@ -569,9 +906,139 @@ def generate_docx(report_data: dict) -> BytesIO:
     except Exception as e: logging.error(f"Error generating DOCX: {e}", exc_info=True); raise
 
 
-# --- FIXED generate_pdf ---
+def with_escaped_source_fields(source: dict) -> dict:
+    """
+    Returns a copy of a source with HTML-escaped title/url/preview fields
+    (title_html, url_html, text_preview_html), computed once when the
+    report is stored instead of on every PDF export.
+    """
+    return {
+        **source,
+        "title_html": html.escape(source.get('title') or 'Source Title Unavailable'),
+        "url_html": html.escape(source.get('url', '')),
+        "text_preview_html": html.escape(source.get('text_preview', '')),
+    }
+
+
+# --- PDF stylesheets (static; built once) ---
+PDF_CONTENT_CSS = """
+    /* Base styles */
+    body { font-family: Arial, Helvetica, sans-serif; font-size: 10pt; line-height: 1.4; color: #333; }
+    h1.report-title { font-size: 16pt; color: #2c3e50; margin-bottom: 5px; font-weight: bold; }
+    h2.query-title { font-size: 11pt; color: #555; font-weight: normal; margin-bottom: 20px; border-bottom: 1px solid #eee; padding-bottom: 10px; }
+    /* Content Styles */
+    .answer-content h2 { font-size: 14pt; color: #2c3e50; margin-top: 1.2em; margin-bottom: 0.6em; font-weight: bold; border-bottom: 1px solid #ccc; padding-bottom: 3px; }
+    .answer-content h3 { font-size: 12pt; color: #2c3e50; margin-top: 1em; margin-bottom: 0.5em; font-weight: bold; border-bottom: 1px solid #eee; padding-bottom: 2px; }
+    .answer-content p { margin-bottom: 0.8em; text-align: justify; }
+    .answer-content ul, .answer-content ol { margin-left: 20px; margin-bottom: 0.8em; } .answer-content ul { list-style-type: disc; } .answer-content ol { list-style-type: decimal; } .answer-content li { margin-bottom: 0.3em; }
+    .answer-content a { color: #0066cc; text-decoration: underline; }
+    /* Citation Marker Style - Improved for PDF */
+    .answer-content sup { display: inline-block; margin: 0 1px; }
+    sup a.citation-marker {
+        font-size: 0.8em;
+        vertical-align: super;
+        padding: 1px 2px;
+        margin: 0 1px;
+        color: #0066cc;
+        text-decoration: none;
+        background-color: #f0f0f0;
+        border-radius: 2px;
+        display: inline-block;
+    }
+    /* Source List Styles */
+    h3.sources-heading { font-size: 14pt; color: #2c3e50; margin-top: 25px; margin-bottom: 10px; border-bottom: 1px solid #ccc; padding-bottom: 5px; page-break-before: always; }
+    ul.sources-list { list-style-type: none; padding-left: 5px; margin-top: 0; }
+    ul.sources-list li { margin-bottom: 8px; font-size: 9pt; line-height: 1.3; }
+    span.source-number { font-weight: bold; margin-right: 5px; color: #111; } span.source-title { color: #333; font-weight: 600; }
+    a.source-url { color: #0066cc; text-decoration: none; font-size: 0.9em; word-break: break-all; }
+    ul.quick-list li { background-color: #f8f8f8; padding: 8px; border: 1px solid #eee; border-radius: 3px;}
+    ul.quick-list a.source-url { display: block; margin-top: 2px; }
+    p.source-preview { color: #555; font-size: 0.85em; margin-top: 5px; margin-bottom: 0; padding-left: 15px; border-left: 2px solid #ddd; max-height: 4.5em; overflow: hidden; }
+    ul.deep-list li { background-color: transparent; padding: 2px 0; border: none; }
+    ul.deep-list a.source-url { display: inline; margin-left: 5px; }
+    ul.deep-list p.source-preview { display: none; }
+"""
+
+# xhtml2pdf draws the header/footer from frames fed by #header_content/#footer_content
+PDF_XHTML2PDF_PAGE_CSS = """
+    @page { size: a4 portrait; margin: 2cm 1.5cm; @frame header_frame { -pdf-frame-content: header_content; left: 1.5cm; width: 18cm; top: 1cm; height: 1cm; } @frame footer_frame { -pdf-frame-content: footer_content; left: 1.5cm; width: 18cm; top: 26.7cm; height: 1cm; } }
+    #header_content, #footer_content { font-size: 9pt; color: #777; } #header_content { text-align: left; } #footer_content { text-align: right; }
+"""
+
+# WeasyPrint uses CSS page margin boxes for the same header/footer
+PDF_WEASYPRINT_PAGE_CSS = """
+    @page {
+        size: A4 portrait; margin: 2cm 1.5cm;
+        @top-left { content: "Research Report"; font-family: Arial, Helvetica, sans-serif; font-size: 9pt; color: #777; }
+        @bottom-right { content: "Page " counter(page) " of " counter(pages); font-family: Arial, Helvetica, sans-serif; font-size: 9pt; color: #777; }
+    }
+"""
+
+PDF_WEASYPRINT_STYLESHEETS = [WeasyCSS(string=PDF_WEASYPRINT_PAGE_CSS + PDF_CONTENT_CSS)] if WeasyCSS else None
+
+# wkhtmltopdf takes page setup and the header/footer as command-line options
+PDF_WKHTMLTOPDF_OPTIONS = {
+    'page-size': 'A4', 'orientation': 'Portrait', 'encoding': 'UTF-8', 'quiet': '',
+    'margin-top': '2cm', 'margin-bottom': '2cm', 'margin-left': '1.5cm', 'margin-right': '1.5cm',
+    'header-left': 'Research Report', 'header-font-name': 'Arial', 'header-font-size': '9',
+    'footer-right': 'Page [page] of [topage]', 'footer-font-name': 'Arial', 'footer-font-size': '9',
+}
+
+# xhtml2pdf document boilerplate (stylesheet, header/footer frames), encoded once; only the title and body vary
+PDF_XHTML2PDF_DOCUMENT_HEAD = f"""<!DOCTYPE html><html><head><meta charset="UTF-8"><style>{PDF_XHTML2PDF_PAGE_CSS}{PDF_CONTENT_CSS}</style>""".encode('utf-8')
+PDF_XHTML2PDF_PAGE_FRAMES = """<div id="header_content">Research Report</div><div id="footer_content">Page <pdf:pagenumber> of <pdf:pagecount></div>"""
+
+
+def _render_pdf_weasyprint(query_html: str, report_body_html: str) -> bytes | None:
+    """Renders the report body with WeasyPrint (stylesheets parsed once at import)."""
+    pdf_html = f"""<!DOCTYPE html><html><head><meta charset="UTF-8"><title>Report: {query_html}</title></head><body>{report_body_html}</body></html>"""
+    return WeasyHTML(string=pdf_html).write_pdf(stylesheets=PDF_WEASYPRINT_STYLESHEETS)
+
+
+def _render_pdf_wkhtmltopdf(query_html: str, report_body_html: str) -> bytes | None:
+    """Renders the report body with the wkhtmltopdf binary via pdfkit."""
+    pdf_html = f"""<!DOCTYPE html><html><head><meta charset="UTF-8"><title>Report: {query_html}</title><style>{PDF_CONTENT_CSS}</style></head><body>{report_body_html}</body></html>"""
+    return pdfkit.from_string(pdf_html, False, options=PDF_WKHTMLTOPDF_OPTIONS, configuration=_wkhtmltopdf_config)
+
+
+def _render_pdf_xhtml2pdf(query_html: str, report_body_html: str) -> bytes | None:
+    """Renders the report body with xhtml2pdf, the pure-Python fallback."""
+    pdf_html = f"""<title>Report: {query_html}</title></head><body>{PDF_XHTML2PDF_PAGE_FRAMES}{report_body_html}</body></html>"""
+    # Passed as UTF-8 bytes with the encoding named, so xhtml2pdf neither re-encodes a str nor sniffs the charset
+    pdf_stream = BytesIO(); pisa_status = pisa.CreatePDF(src=PDF_XHTML2PDF_DOCUMENT_HEAD + pdf_html.encode('utf-8'), dest=pdf_stream, encoding='utf-8')
+    if pisa_status.err: logging.error(f"PDF generation failed: {pisa_status.err}"); return None
+    return pdf_stream.getvalue()
+
+
+PDF_RENDERERS = {"weasyprint": _render_pdf_weasyprint, "wkhtmltopdf": _render_pdf_wkhtmltopdf, "xhtml2pdf": _render_pdf_xhtml2pdf}
+
+
+def _load_wkhtmltopdf_config():
+    """Locates the wkhtmltopdf binary (WKHTMLTOPDF_PATH or PATH); None if pdfkit or the binary is missing."""
+    if pdfkit is None: return None
+    try: return pdfkit.configuration(wkhtmltopdf=os.getenv("WKHTMLTOPDF_PATH", ""))
+    except OSError as e: logging.warning(f"wkhtmltopdf not found: {e}"); return None
+
+
+def select_pdf_backend(requested: str) -> str:
+    """
+    Resolves the PDF_BACKEND setting to an engine that is actually installed.
+
+    'auto' prefers WeasyPrint; any unavailable or unknown engine falls back
+    to xhtml2pdf, which is always installed.
+    """
+    available = {"weasyprint": WeasyHTML is not None, "wkhtmltopdf": _wkhtmltopdf_config is not None, "xhtml2pdf": True}
+    if requested == "auto": return "weasyprint" if available["weasyprint"] else "xhtml2pdf"
+    if available.get(requested): return requested
+    logging.warning(f"PDF backend '{requested}' is not available; falling back to xhtml2pdf."); return "xhtml2pdf"
+
+
+_wkhtmltopdf_config = _load_wkhtmltopdf_config() if PDF_BACKEND == "wkhtmltopdf" else None
+PDF_BACKEND_SELECTED = select_pdf_backend(PDF_BACKEND)
+
+
 def generate_pdf(report_data: dict) -> BytesIO | None:
-    """Generates PDF, ensuring depth check and using updated CSS."""
+    """Generates PDF with the engine selected by PDF_BACKEND (see select_pdf_backend)."""
     try:
         query = report_data.get('query', 'Untitled Report')
         answer_html_content = report_data.get('answer_html', '<p>Content not available.</p>')
@@ -581,77 +1048,139 @@ def generate_pdf(report_data: dict) -> BytesIO | None:
         source_list_html = ""
         if sources:
             list_class = "sources-list " + ("deep-list" if research_depth == 'deep' else "quick-list")
-            source_list_html = f'<ul class="{list_class}">'
+            parts = [f'<ul class="{list_class}">']
             for i, source in enumerate(sources):
-                title = html.escape(source.get('title', 'Source Title Unavailable'))
-                url = html.escape(source.get('url', ''))
-                preview = html.escape(source.get('text_preview', ''))
-                source_list_html += f'<li><span class="source-number">[{i+1}]</span> <span class="source-title">{title}</span>'
-                if research_depth == 'deep' and url: source_list_html += f' <a href="{url}" class="source-url">({url})</a>'
-                elif research_depth == 'quick' and url: source_list_html += f'<br><a href="{url}" class="source-url">{url}</a>'
-                if research_depth == 'quick' and preview: source_list_html += f'<p class="source-preview">{preview}...</p>'
-                source_list_html += '</li>'
-            source_list_html += "</ul>"
+                title = source['title_html']; url = source['url_html']; preview = source['text_preview_html']
+                parts.append(f'<li><span class="source-number">[{i+1}]</span> <span class="source-title">{title}</span>')
+                if research_depth == 'deep' and url: parts.append(f' <a href="{url}" class="source-url">({url})</a>')
+                elif research_depth == 'quick' and url: parts.append(f'<br><a href="{url}" class="source-url">{url}</a>')
+                if research_depth == 'quick' and preview: parts.append(f'<p class="source-preview">{preview}...</p>')
+                parts.append('</li>')
+            parts.append("</ul>")
+            source_list_html = "".join(parts)
         else: source_list_html = "<p>No sources were cited.</p>"
 
         sources_heading_text = "References" if research_depth == 'deep' else "Sources Cited"
 
-        # --- PDF HTML and CSS ---
-        # In the generate_pdf function, update the CSS for citation markers:
-        # In the generate_pdf function, update the CSS for citation markers:
-        pdf_html = f"""
-        <!DOCTYPE html><html><head><meta charset="UTF-8"><title>Report: {html.escape(query)}</title><style>
-            /* Base styles */
-            @page {{ size: a4 portrait; margin: 2cm 1.5cm; @frame header_frame {{ -pdf-frame-content: header_content; left: 1.5cm; width: 18cm; top: 1cm; height: 1cm; }} @frame footer_frame {{ -pdf-frame-content: footer_content; left: 1.5cm; width: 18cm; top: 26.7cm; height: 1cm; }} }}
-            body {{ font-family: Arial, Helvetica, sans-serif; font-size: 10pt; line-height: 1.4; color: #333; }}
-            #header_content, #footer_content {{ font-size: 9pt; color: #777; }} #header_content {{ text-align: left; }} #footer_content {{ text-align: right; }}
-            h1.report-title {{ font-size: 16pt; color: #2c3e50; margin-bottom: 5px; font-weight: bold; }}
-            h2.query-title {{ font-size: 11pt; color: #555; font-weight: normal; margin-bottom: 20px; border-bottom: 1px solid #eee; padding-bottom: 10px; }}
-            /* Content Styles */
-            .answer-content h2 {{ font-size: 14pt; color: #2c3e50; margin-top: 1.2em; margin-bottom: 0.6em; font-weight: bold; border-bottom: 1px solid #ccc; padding-bottom: 3px; }}
-            .answer-content h3 {{ font-size: 12pt; color: #2c3e50; margin-top: 1em; margin-bottom: 0.5em; font-weight: bold; border-bottom: 1px solid #eee; padding-bottom: 2px; }}
-            .answer-content p {{ margin-bottom: 0.8em; text-align: justify; }}
-            .answer-content ul, .answer-content ol {{ margin-left: 20px; margin-bottom: 0.8em; }} .answer-content ul {{ list-style-type: disc; }} .answer-content ol {{ list-style-type: decimal; }} .answer-content li {{ margin-bottom: 0.3em; }}
-            .answer-content a {{ color: #0066cc; text-decoration: underline; }}
-            /* Citation Marker Style - Improved for PDF */
-            .answer-content sup {{ display: inline-block; margin: 0 1px; }}
-            sup a.citation-marker {{
-                font-size: 0.8em;
-                vertical-align: super;
-                padding: 1px 2px;
-                margin: 0 1px;
-                color: #0066cc;
-                text-decoration: none;
-                background-color: #f0f0f0;
-                border-radius: 2px;
-                display: inline-block;
-            }}
-            /* Source List Styles */
-            h3.sources-heading {{ font-size: 14pt; color: #2c3e50; margin-top: 25px; margin-bottom: 10px; border-bottom: 1px solid #ccc; padding-bottom: 5px; page-break-before: always; }}
-            ul.sources-list {{ list-style-type: none; padding-left: 5px; margin-top: 0; }}
-            ul.sources-list li {{ margin-bottom: 8px; font-size: 9pt; line-height: 1.3; }}
-            span.source-number {{ font-weight: bold; margin-right: 5px; color: #111; }} span.source-title {{ color: #333; font-weight: 600; }}
-            a.source-url {{ color: #0066cc; text-decoration: none; font-size: 0.9em; word-break: break-all; }}
-            ul.quick-list li {{ background-color: #f8f8f8; padding: 8px; border: 1px solid #eee; border-radius: 3px;}}
-            ul.quick-list a.source-url {{ display: block; margin-top: 2px; }}
-            p.source-preview {{ color: #555; font-size: 0.85em; margin-top: 5px; margin-bottom: 0; padding-left: 15px; border-left: 2px solid #ddd; max-height: 4.5em; overflow: hidden; }}
-            ul.deep-list li {{ background-color: transparent; padding: 2px 0; border: none; }}
-            ul.deep-list a.source-url {{ display: inline; margin-left: 5px; }}
-            ul.deep-list p.source-preview {{ display: none; }}
-            </style></head><body>
-            <div id="header_content">Research Report</div><div id="footer_content">Page <pdf:pagenumber> of <pdf:pagecount></div>
-            <h1 class="report-title">Research Report</h1><h2 class="query-title">Query: {html.escape(query)}</h2>
+        # --- PDF HTML ---
+        query_html = html.escape(query)  # Escaped once; used in the body and the document title
+        report_body_html = f"""
+            <h1 class="report-title">Research Report</h1><h2 class="query-title">Query: {query_html}</h2>
             <div class="answer-content">{answer_html_content}</div>
             <h3 class="sources-heading">{sources_heading_text}</h3>
-            {source_list_html}
-            </body></html>"""
+            {source_list_html}"""
 
-        pdf_stream = BytesIO(); pisa_status = pisa.CreatePDF(src=pdf_html, dest=pdf_stream)
-        if pisa_status.err: logging.error(f"PDF generation failed: {pisa_status.err}"); return None
-        else: pdf_stream.seek(0); logging.info(f"PDF generated successfully (Depth: {research_depth})"); return pdf_stream
+        pdf_bytes = PDF_RENDERERS[PDF_BACKEND_SELECTED](query_html, report_body_html)
+        if pdf_bytes is None: return None
+        logging.info(f"PDF generated successfully with {PDF_BACKEND_SELECTED} (Depth: {research_depth})"); return BytesIO(pdf_bytes)
     except Exception as e: logging.error(f"Exception during PDF generation: {e}", exc_info=True); return None
 
 
+# --- Background export rendering (rendered bytes are kept on the stored report) ---
+EXPORT_RENDERERS = {"pdf": generate_pdf, "docx": generate_docx}
+
+
+def _render_export(fmt: str, report_data: dict) -> bytes | None:
+    """Renders one export format to bytes."""
+    stream = EXPORT_RENDERERS[fmt](report_data)
+    return stream.getvalue() if stream else None
+
+
+def store_export_bytes(report_id: str, report_data: dict, fmt: str, data: bytes) -> None:
+    """Keeps rendered export bytes on the report (as pdf_bytes/docx_bytes), refreshing the Redis copy if configured."""
+    with _report_store_lock:
+        report_data[f"{fmt}_bytes"] = data
+        if _report_redis is not None: add_to_report_store(report_id, report_data)
+
+
+def _prerender_export(report_id: str, fmt: str, report_data: dict) -> None:
+    """Export pool task: renders one format and stores its bytes on the report."""
+    data = _render_export(fmt, report_data)
+    if data: store_export_bytes(report_id, report_data, fmt, data)
+
+
+def _forget_export_job(key: tuple[str, str]) -> None:
+    """Drops a finished render's future; its bytes now live on the report."""
+    with _export_jobs_lock: _export_jobs.pop(key, None)
+
+
+def prerender_exports(report_id: str, report_data: dict) -> None:
+    """Queues the report's PDF/DOCX rendering on the export pool so a later download does not block on it."""
+    for fmt in EXPORT_PRERENDER_FORMATS:
+        future = _export_pool.submit(_prerender_export, report_id, fmt, report_data)
+        with _export_jobs_lock: _export_jobs[(report_id, fmt)] = future
+        future.add_done_callback(lambda _, key=(report_id, fmt): _forget_export_job(key))
+
+
+def get_export_bytes(report_id: str, fmt: str, report_data: dict) -> bytes | None:
+    """
+    Returns a report's rendered export: the stored bytes, after waiting for
+    its background render if one is already running, or an inline render
+    (stored for next time) if none was queued, it was still waiting behind
+    other renders (it is cancelled), or it failed.
+
+    Args:
+        report_id (str): Unique identifier for the report
+        fmt (str): 'pdf' or 'docx'
+        report_data (dict): Stored report data
+
+    Returns:
+        bytes | None: The rendered file, or None if rendering failed
+    """
+    with _export_jobs_lock: future = _export_jobs.get((report_id, fmt))
+    if future is not None and not future.cancel():  # A queued render is cancelled and done inline instead
+        try: future.result()
+        except Exception as e: logging.warning(f"Background {fmt} render failed for {report_id}, rendering inline: {e}")
+    data = report_data.get(f"{fmt}_bytes")
+    if data: return data
+    data = _render_export(fmt, report_data)
+    if data: store_export_bytes(report_id, report_data, fmt, data)
+    return data
+
+
+def json_response(payload: dict, status: int = 200):
+    """Serializes a JSON response with orjson when installed, otherwise with jsonify."""
+    if orjson is None: return jsonify(payload), status
+    return current_app.response_class(orjson.dumps(payload), status=status, mimetype='application/json')
+
+
+def parse_json_body() -> dict | None:
+    """Parses the request body as a JSON object (orjson when installed); None if it is not one."""
+    if orjson is None: data = request.get_json(silent=True, cache=False)
+    else:
+        try: data = orjson.loads(request.get_data(cache=False))
+        except orjson.JSONDecodeError: data = None
+    return data if isinstance(data, dict) else None
+
+
+def gzip_json_response(response):
+    """after_request hook: gzips JSON bodies of at least JSON_GZIP_MIN_BYTES for clients that accept gzip."""
+    if response.mimetype != 'application/json' or response.direct_passthrough or 'Content-Encoding' in response.headers: return response
+    response.vary.add('Accept-Encoding')
+    if request.accept_encodings['gzip'] <= 0: return response
+    body = response.get_data()
+    if len(body) < JSON_GZIP_MIN_BYTES: return response
+    response.set_data(gzip.compress(body, compresslevel=JSON_GZIP_LEVEL)); response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def cacheable_download(response, etag: str):
+    """Marks a download response (or its 304) as browser-cacheable under the given ETag."""
+    response.set_etag(etag); response.headers['Cache-Control'] = DOWNLOAD_CACHE_CONTROL
+    return response
+
+
+def not_modified_download(etag: str):
+    """Returns a 304 for a download the browser already holds."""
+    return cacheable_download(current_app.response_class(status=304), etag)
+
+
+def report_filename(report_data: dict, extension: str) -> str:
+    """Builds the download filename from the first 30 characters of the report's query."""
+    query_slug = _RE_FILENAME_UNSAFE.sub("_", report_data.get('query', 'report')[:30]).strip('_')
+    return f"Research_Report_{query_slug or 'report'}.{extension}"
+
+
 # --- Flask App Initialization and Routes ---
 def create_app():
     app = Flask(__name__)
@@ -660,59 +1189,77 @@ def create_app():
     app.config['GEMINI_API_KEY'] = os.getenv("GEMINI_API_KEY")
     if not app.config['GEMINI_API_KEY']: logging.warning("GEMINI_API_KEY not found.")
     else: logging.info("GEMINI_API_KEY found.")
+    app.after_request(gzip_json_response)
     @app.route('/')
     def index(): return render_template('index.html')
 
     @app.route('/process', methods=['POST'])
     def process_query_route():
         # (Keep route logic as before - stores depth correctly)
-        start_time = time.time(); data = request.get_json(); query = data.get('query', '').strip()
-        research_depth = data.get('depth', 'quick')
-        if not request.is_json: return jsonify({"error": "Request must be JSON"}), 400
-        if not query: return jsonify({"error": "Query cannot be empty."}), 400
+        start_time = time.time()
+        if not request.is_json: return json_response({"error": "Request must be JSON"}, 400)
+        data = parse_json_body()
+        if data is None: return json_response({"error": "Request body must be a JSON object."}, 400)
+        query = data.get('query', '').strip()
+        research_depth = data.get('depth', 'quick'); force_rescrape = bool(data.get('forceRescrape', False))
+        if not query: return json_response({"error": "Query cannot be empty."}, 400)
         api_key = current_app.config.get('GEMINI_API_KEY')
-        if not api_key: return jsonify({"error": "AI model not configured."}), 500
-        logging.info(f"Processing query: '{query}' [Depth: {research_depth}]")
+        if not api_key: return json_response({"error": "AI model not configured."}, 500)
+        logging.info(f"Processing query: '{query}' [Depth: {research_depth}]{' [Force rescrape]' if force_rescrape else ''}")
         try:
+            # The query embedding is computed while the search runs and only waited for when it is used
+            embedding_future = _embedding_pool.submit(embed_query, query, api_key)
             num_results = DEEP_SEARCH_RESULTS if research_depth == 'deep' else QUICK_SEARCH_RESULTS
             search_results = perform_search(query, num_results=num_results)
+            if not force_rescrape and has_semantic_cache_entries(research_depth):
+                query_embedding = embedding_future.result()
+                cached_id = find_similar_report(query_embedding, research_depth) if query_embedding else None
+                cached_report = get_from_report_store(cached_id) if cached_id else None
+                if cached_report:
+                    logging.info(f"Answered '{query}' from stored report {cached_id} (query '{cached_report['query']}') in {time.time() - start_time:.2f}s.")
+                    cached_sources = [{k: s[k] for k in SOURCE_SUMMARY_FIELDS} for s in cached_report["sources"]]
+                    return json_response({"answer_html": cached_report["answer_html"], "sources": cached_sources, "report_id": cached_id, "research_depth": research_depth, "cached": True, "matched_query": cached_report["query"]})
             urls_to_scrape = [r['url'] for r in search_results if r.get('url')]
-            url_to_title_map = {r['url']: r.get('title') for r in search_results if r.get('url')}
-            if not urls_to_scrape: return jsonify({"error": "Could not find relevant web sources."}), 404
+            if not urls_to_scrape: return json_response({"error": "Could not find relevant web sources."}, 404)
             logging.info(f"Attempting to scrape {len(urls_to_scrape)} URLs.")
-            scraped_data = scrape_urls(urls_to_scrape)
-            if not scraped_data: return jsonify({"error": "Failed to retrieve usable content from web sources."}), 500
+            scraped_data = scrape_urls(search_results, research_depth, force_rescrape)
+            if not scraped_data: return json_response({"error": "Failed to retrieve usable content from web sources."}, 500)
             success_rate = len(scraped_data) / len(urls_to_scrape) if urls_to_scrape else 0
             if success_rate < 0.4: logging.warning(f"Low scrape success rate ({success_rate:.1%}).")
             synthesis_result = synthesize_with_gemini(query, scraped_data, api_key, research_depth)
-            sources_final = []
-            for item in scraped_data: preview = item.get('text', '')[:SOURCE_PREVIEW_LENGTH]; sources_final.append({"id": item["id"], "url": item["url"], "title": url_to_title_map.get(item["url"], f"Source {item['id']+1}"), "text_preview": preview})
-            if not synthesis_result or "error" in synthesis_result: error_msg = synthesis_result.get("error", "AI synthesis failed.") if synthesis_result else "AI synthesis failed."; logging.error(f"Synthesis failed: {error_msg}"); return jsonify({"error": f"AI Synthesis Error: {error_msg}", "sources": sources_final, "research_depth": research_depth}), 500
+            sources_final = [{k: item[k] for k in SOURCE_SUMMARY_FIELDS} for item in scraped_data]
+            if not synthesis_result or "error" in synthesis_result: error_msg = synthesis_result.get("error", "AI synthesis failed.") if synthesis_result else "AI synthesis failed."; logging.error(f"Synthesis failed: {error_msg}"); return json_response({"error": f"AI Synthesis Error: {error_msg}", "sources": sources_final, "research_depth": research_depth}, 500)
             report_id = str(uuid.uuid4())
             # Ensure depth is stored correctly
-            report_full_data = {"query": query, "answer_raw": synthesis_result["answer_raw"], "answer_html": synthesis_result["answer_html"], "sources": sources_final, "research_depth": research_depth}
-            add_to_report_store(report_id, report_full_data)
+            report_full_data = {"query": query, "answer_raw": synthesis_result["answer_raw"], "answer_html": synthesis_result["answer_html"], "sources": [with_escaped_source_fields(s) for s in sources_final], "research_depth": research_depth}
+            add_to_report_store(report_id, report_full_data); prerender_exports(report_id, report_full_data)
+            query_embedding = embedding_future.result()
+            if query_embedding: add_to_semantic_cache(report_id, research_depth, query_embedding)
             end_time = time.time(); logging.info(f"Success query '{query}' in {end_time - start_time:.2f}s. ID: {report_id}")
-            return jsonify({"answer_html": synthesis_result["answer_html"], "sources": sources_final, "report_id": report_id, "research_depth": research_depth}) # Return depth
-        except Exception as e: logging.exception(f"Unexpected error in '/process': {e}"); return jsonify({"error": "An unexpected internal server error."}), 500
+            return json_response({"answer_html": synthesis_result["answer_html"], "sources": sources_final, "report_id": report_id, "research_depth": research_depth}) # Return depth
+        except Exception as e: logging.exception(f"Unexpected error in '/process': {e}"); return json_response({"error": "An unexpected internal server error."}, 500)
 
     @app.route('/download/docx/<report_id>')
     def download_docx_route(report_id):
         # (generate_docx now correctly checks depth from report_data)
-        report_data = report_store.get(report_id)
+        report_data = get_from_report_store(report_id)
         if not report_data: return "Report not found or has expired.", 404
-        try: file_stream = generate_docx(report_data); query_slug = "".join(c if c.isalnum() else "_" for c in report_data.get('query', 'report'))[:30].strip('_'); filename = f"Research_Report_{query_slug or 'report'}.docx"; logging.info(f"Serving DOCX: {filename}"); return send_file(file_stream, mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document', as_attachment=True, download_name=filename)
+        etag = f"{report_id}-docx"
+        if request.if_none_match.contains(etag): return not_modified_download(etag)
+        try: file_stream = BytesIO(get_export_bytes(report_id, 'docx', report_data)); filename = report_filename(report_data, 'docx'); logging.info(f"Serving DOCX: {filename}"); return cacheable_download(send_file(file_stream, mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document', as_attachment=True, download_name=filename), etag)
         except Exception as e: logging.error(f"Error generating/sending DOCX: {e}", exc_info=True); return "Error generating DOCX file.", 500 # Log exception detail
 
     @app.route('/download/pdf/<report_id>')
     def download_pdf_route(report_id):
         # (generate_pdf now correctly checks depth from report_data)
-        report_data = report_store.get(report_id)
+        report_data = get_from_report_store(report_id)
         if not report_data: return "Report not found or has expired.", 404
+        etag = f"{report_id}-pdf"
+        if request.if_none_match.contains(etag): return not_modified_download(etag)
         try:
-            pdf_stream = generate_pdf(report_data)
-            if not pdf_stream: logging.error(f"PDF generation returned None for report {report_id}"); return "Error generating PDF file (check server logs).", 500
-            query_slug = "".join(c if c.isalnum() else "_" for c in report_data.get('query', 'report'))[:30].strip('_'); filename = f"Research_Report_{query_slug or 'report'}.pdf"; logging.info(f"Serving PDF: {filename}"); response = make_response(pdf_stream.getvalue()); response.headers['Content-Type'] = 'application/pdf'; response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'; return response
+            pdf_bytes = get_export_bytes(report_id, 'pdf', report_data)
+            if not pdf_bytes: logging.error(f"PDF generation returned None for report {report_id}"); return "Error generating PDF file (check server logs).", 500
+            filename = report_filename(report_data, 'pdf'); logging.info(f"Serving PDF: {filename}"); response = make_response(pdf_bytes); response.headers['Content-Type'] = 'application/pdf'; response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'; return cacheable_download(response, etag)
         except Exception as e: logging.error(f"Error generating/sending PDF: {e}", exc_info=True); return "Error generating PDF file.", 500 # Log exception detail
 
     return app
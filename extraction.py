@@ -0,0 +1,97 @@
+# --- START OF FILE extraction.py ---
+# HTML main-content extraction. Kept apart from app.py so the extraction
+# process pool's workers import only trafilatura and the HTML parsers.
+
+import logging
+
+from bs4 import BeautifulSoup
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:  # Optional: falls back to BeautifulSoup
+    LexborHTMLParser = None
+import trafilatura
+
+# --- Constants ---
+MAX_CONTENT_LENGTH_PER_SITE = 15000
+FALLBACK_CONTAINER_SELECTORS = ('article', 'main', 'div#content', 'div.content', 'div#main-content', 'div.main-content', 'div.entry-content', 'div[role=main]')
+
+
+def init_extraction_worker(log_level: int, log_format: str) -> None:
+    """Process pool initializer: gives worker log records the app's level and format."""
+    logging.basicConfig(level=log_level, format=log_format)
+
+
+def extract_main_content(content: bytes, url: str) -> str | None:
+    """
+    Extracts the main text of an HTML page, with Trafilatura fix.
+    Runs in the extraction process pool, so it must stay picklable (module level).
+
+    Args:
+        content (bytes): Raw HTML
+        url (str): Source URL (for logging)
+
+    Returns:
+        str | None: Extracted content or None if nothing usable was found
+    """
+    # 1. Try Trafilatura
+    try:
+        # --- FIX: Use 'txt' for output format ---
+        main_content = trafilatura.extract(
+            content, include_comments=False,
+            include_tables=False, output_format='txt' # CORRECTED format
+        )
+        # --- End FIX ---
+        if main_content and len(main_content) > 100:
+            logging.info(f"Trafilatura success ({len(main_content)} chars): {url}")
+            return main_content.strip()[:MAX_CONTENT_LENGTH_PER_SITE]
+        else:
+            logging.warning(f"Trafilatura extracted minimal/no content (len={len(main_content or '')}) from: {url}")
+    except TypeError as te:
+         # Catch TypeErrors which might indicate wrong args for the installed version
+         logging.error(f"Trafilatura extract failed for {url}: {te.__class__.__name__} - {te}", exc_info=False)
+    except Exception as e:
+        logging.error(f"Trafilatura failed for {url}: {e.__class__.__name__} - {e}", exc_info=False)
+
+    # 2. Fallback to paragraph extraction (selectolax, or BeautifulSoup if unavailable)
+    logging.info(f"Falling back to paragraph extraction for: {url}")
+    try:
+        text = _extract_paragraphs_selectolax(content, url) if LexborHTMLParser else _extract_paragraphs_bs4(content, url)
+        return text.strip()[:MAX_CONTENT_LENGTH_PER_SITE] if text else None
+    except Exception as e: logging.error(f"Generic Error in fallback extraction {url}:", exc_info=True); return None
+
+
+def _extract_paragraphs_selectolax(content: bytes, url: str) -> str | None:
+    """Joins the <p> text of the first main-content container, parsed with selectolax."""
+    tree = LexborHTMLParser(content)
+    root = tree.body or tree.root
+    if root is None: logging.warning(f"selectolax found no document: {url}"); return None
+    for selector in FALLBACK_CONTAINER_SELECTORS:
+        container = tree.css_first(selector)
+        if container:
+            extracted_text = ' '.join(p.text(strip=True) for p in container.css('p'))
+            if len(extracted_text) > 200: logging.info(f"selectolax using container '{selector}' ({len(extracted_text)} chars): {url}"); return extracted_text
+    extracted_text = ' '.join(p.text(strip=True) for p in root.css('p'))
+    if len(extracted_text) > 100: logging.info(f"selectolax joining all 'p' tags ({len(extracted_text)} chars): {url}"); return extracted_text
+    body_snippet = root.text(strip=True, separator=' ')[0:500]; logging.warning(f"selectolax fallback found no content. Snippet: '{body_snippet}...': {url}"); return None
+
+
+def _extract_paragraphs_bs4(content: bytes, url: str) -> str | None:
+    """Joins the <p> text of the first main-content container, parsed with BeautifulSoup."""
+    soup = BeautifulSoup(content, 'lxml')
+    potential_containers = [soup.find('article'), soup.find('main'), soup.find('div', id='content'), soup.find('div', class_='content'), soup.find('div', id='main-content'), soup.find('div', class_='main-content'), soup.find('div', class_='entry-content'), soup.find('div', role='main'), soup]
+    text = ""
+    for container in potential_containers:
+        if container:
+            paragraphs = container.find_all('p', recursive=True)
+            if paragraphs:
+                extracted_text = ' '.join(p.get_text(strip=True) for p in paragraphs)
+                if len(extracted_text) > 200: text = extracted_text; logging.info(f"BS4 using container '{container.name}' ({len(text)} chars): {url}"); break
+    if not text:
+         all_paragraphs = soup.find_all('p')
+         if all_paragraphs:
+              extracted_text = ' '.join(p.get_text(strip=True) for p in all_paragraphs)
+              if len(extracted_text) > 100: text = extracted_text; logging.info(f"BS4 joining all 'p' tags ({len(text)} chars): {url}");
+    if text: return text
+    else: body_snippet = soup.body.get_text(strip=True, separator=' ')[0:500] if soup.body else "No body"; logging.warning(f"BS4 fallback found no content. Snippet: '{body_snippet}...': {url}"); return None
+
+# --- END OF FILE extraction.py ---
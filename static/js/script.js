@@ -90,6 +90,12 @@ document.addEventListener('DOMContentLoaded', () => {
 
     function displayResults(data) {
         answerContent.innerHTML = data.answer_html;
+        if (data.cached) { // Answer reused from a stored report for a near-identical query
+            const note = document.createElement('p');
+            note.className = 'reused-answer-note';
+            note.textContent = `Reused the answer to an earlier, similar query: "${data.matched_query}"`;
+            answerContent.prepend(note);
+        }
         sourcesData = data.sources || [];
         // Render source list based on the depth returned by the backend
         renderSourceList(sourcesData, data.research_depth);
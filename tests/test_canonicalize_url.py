@@ -0,0 +1,14 @@
+from app import canonicalize_url, scrape_urls
+
+
+def test_equivalent_urls_share_a_key():
+    assert canonicalize_url("HTTPS://Example.com/a/?utm_source=x&b=2&a=1#top") == canonicalize_url("https://example.com/a?a=1&b=2")
+
+
+def test_malformed_url_is_its_own_key():
+    assert canonicalize_url("http://[::1/x") == "http://[::1/x"
+
+
+def test_malformed_search_url_does_not_abort_scraping():
+    results = [{"url": "http://[::1/x", "title": "Bad", "body": "b" * 400}, {"url": "https://example.com/", "title": "Good", "body": "g" * 400}]
+    assert [source["url"] for source in scrape_urls(results, depth='quick')] == ["http://[::1/x", "https://example.com/"]